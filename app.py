@@ -1,11 +1,20 @@
 import streamlit as st
+import psutil
 import subprocess
 import threading
 import time
 import os
+import sys
 import sqlite3
 import random
-from datetime import datetime
+import re
+import shutil
+import queue
+import atexit
+import selectors
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
 
 # --- PAGE CONFIG ---
@@ -18,86 +27,213 @@ VIDEO_DIR.mkdir(parents=True, exist_ok=True)
 AUDIO_DIR.mkdir(parents=True, exist_ok=True)
 
 # --- DATABASE SETUP ---
-def init_database():
+DB_PATH = "streaming_logs.db"
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 0.5
+LOG_RETENTION_DAYS = 7
+LOG_VACUUM_INTERVAL = 300
+LOG_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS streaming_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        session_id INTEGER NOT NULL,
+        log_type TEXT NOT NULL,
+        message TEXT NOT NULL
+    )
+'''
+LOG_INSERT_SQL = "INSERT INTO streaming_logs (timestamp, session_id, log_type, message) VALUES "
+
+@st.cache_resource
+def get_db():
+    # One connection for the whole server process; Streamlit re-executes
+    # this script on every rerun, so a plain module global would not survive.
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    # Only takes effect on a new database file; older files keep their mode
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    return conn, threading.Lock()
+
+@st.cache_resource
+def prune_old_logs(_conn):
+    # Runs once per server process: drop old sessions and shrink the WAL
+    cutoff = (datetime.now() - timedelta(days=LOG_RETENTION_DAYS)).isoformat()
+    _conn.execute("DELETE FROM streaming_logs WHERE timestamp < ?", (cutoff,))
+    _conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+@st.cache_resource
+def migrate_session_ids(_conn):
+    # Older databases stored session_id as TEXT "session_<epoch>"; rebuild with INTEGER ids
+    columns = {row[1]: row[2] for row in _conn.execute("PRAGMA table_info(streaming_logs)")}
+    if columns.get("session_id", "").upper() != "TEXT":
+        return
     try:
-        db_path = Path("streaming_logs.db")
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS streaming_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp TEXT NOT NULL,
-                session_id TEXT NOT NULL,
-                log_type TEXT NOT NULL,
-                message TEXT NOT NULL
-            )
+        _conn.execute("BEGIN")
+        _conn.execute("ALTER TABLE streaming_logs RENAME TO streaming_logs_legacy")
+        _conn.execute(LOG_TABLE_SQL)
+        _conn.execute('''
+            INSERT INTO streaming_logs (id, timestamp, session_id, log_type, message)
+            SELECT id, timestamp, CAST(REPLACE(session_id, 'session_', '') AS INTEGER), log_type, message
+            FROM streaming_logs_legacy
         ''')
-        conn.commit()
-        conn.close()
+        _conn.execute("DROP TABLE streaming_logs_legacy")
+        _conn.execute("COMMIT")
+    except Exception:
+        if _conn.in_transaction:
+            _conn.execute("ROLLBACK")
+        raise
+
+def init_database():
+    try:
+        conn, lock = get_db()
+        with lock:
+            conn.execute(LOG_TABLE_SQL)
+            migrate_session_ids(conn)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_session_ts ON streaming_logs(session_id, timestamp DESC)")
+            prune_old_logs(conn)
     except Exception as e:
         st.error(f"Database error: {e}")
 
+def _log_writer_loop(log_queue):
+    conn, lock = get_db()
+    cursor = conn.cursor()
+    last_vacuum = time.monotonic()
+    while True:
+        rows = [log_queue.get()]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while len(rows) < LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(log_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        with lock:
+            try:
+                cursor.execute("BEGIN")
+                # One multi-row INSERT per batch: a single statement for all rows.
+                # LOG_BATCH_SIZE * 4 parameters stays under SQLite's 999 limit.
+                sql = LOG_INSERT_SQL + ",".join(["(?, ?, ?, ?)"] * len(rows))
+                cursor.execute(sql, list(itertools.chain.from_iterable(rows)))
+                cursor.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                print(f"Error logging, dropped {len(rows)} rows: {e}", file=sys.stderr)
+            if time.monotonic() - last_vacuum >= LOG_VACUUM_INTERVAL:
+                last_vacuum = time.monotonic()
+                try:
+                    # Step through all rows, otherwise only one page is freed
+                    cursor.execute("PRAGMA incremental_vacuum(1000)").fetchall()
+                except Exception as e:
+                    print(f"Error vacuuming logs: {e}", file=sys.stderr)
+
+@st.cache_resource
+def get_log_queue():
+    # Log lines are queued and written in batches by a single writer thread
+    # per server process, so FFmpeg output handling never waits on a commit.
+    log_queue = queue.Queue()
+    threading.Thread(target=_log_writer_loop, args=(log_queue,), daemon=True).start()
+    return log_queue
+
 def log_to_database(session_id, log_type, message):
-    try:
-        conn = sqlite3.connect("streaming_logs.db")
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO streaming_logs (timestamp, session_id, log_type, message)
-            VALUES (?, ?, ?, ?)
-        ''', (datetime.now().isoformat(), session_id, log_type, message))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        st.error(f"Error logging: {e}")
+    get_log_queue().put((datetime.now().isoformat(), session_id, log_type, message))
 
 # --- STREAMING CORE ---
+# FFmpeg output lines worth logging, matched on raw bytes in a single pass
+FFMPEG_LOG_PATTERN = re.compile(rb"Error|bitrate")
+# The stats line is redrawn with \r, so split on either line ending
+FFMPEG_LINE_SPLIT = re.compile(rb"[\r\n]")
+# Minimum playlist entries; short libraries get several independently shuffled passes
+PLAYLIST_LENGTH = 16
+
+@st.cache_resource
+def get_stream_slot():
+    # The app drives a single YouTube stream key, so there is one app-wide slot
+    # rather than one per browser session. "starting" covers the gap between
+    # Start and Popen; "session_id" tags the logs of the live stream.
+    # The playlists loop forever, so FFmpeg must not outlive the server.
+    atexit.register(stop_all_ffmpeg)
+    return {"starting": False, "session_id": None}
+
+def find_ffmpeg_processes():
+    # FFmpeg children of this server process, looked up from the OS rather than
+    # Streamlit state so a reload, a new tab or a cleared cache can still reach them
+    found = []
+    for child in psutil.Process().children():
+        try:
+            if child.name() == "ffmpeg" and child.status() != psutil.STATUS_ZOMBIE:
+                found.append(child)
+        except psutil.NoSuchProcess:
+            pass
+    return found
+
+def is_streaming():
+    return get_stream_slot()["starting"] or bool(find_ffmpeg_processes())
+
 def run_ffmpeg(stream_key, session_id):
+    slot = get_stream_slot()
     output_url = f"rtmp://a.rtmp.youtube.com/live2/{stream_key}"
     
     # To achieve seamless random play without disconnects, 
-    # we use a concat demuxer with a generated list.
+    # we use a concat demuxer with a short generated list that
+    # FFmpeg loops forever (-stream_loop -1). It only ends through Stop
+    # (see find_ffmpeg_processes) or when the server exits.
     
     def get_random_playlist():
-        vids = list(VIDEO_DIR.glob("*"))
-        auds = list(AUDIO_DIR.glob("*"))
+        # scandir reuses the directory entry type, avoiding a stat() per file
+        vids = [entry.path for entry in os.scandir(VIDEO_DIR) if entry.is_file()]
+        auds = [entry.path for entry in os.scandir(AUDIO_DIR) if entry.is_file()]
         return vids, auds
 
     vids, auds = get_random_playlist()
     if not vids:
         log_to_database(session_id, "ERROR", "No video files found in media/videos")
+        slot["starting"] = False
         return
 
     video_list_path = Path(f"videos_{session_id}.txt")
     audio_list_path = Path(f"audios_{session_id}.txt")
     
-    def update_lists():
-        v, a = get_random_playlist()
+    def shuffled(lines):
+        # Every file plays once per pass, in a fresh random order each pass
+        playlist = []
+        while len(playlist) < PLAYLIST_LENGTH:
+            playlist += random.sample(lines, len(lines))
+        return playlist
+
+    def update_lists(v, a):
+        # Resolve paths once and build each concat line a single time
+        cwd = os.getcwd()
         if v:
-            with open(video_list_path, "w") as f:
-                # Shuffle before creating the list for true randomness
-                v_shuffled = list(v)
-                random.shuffle(v_shuffled)
-                for _ in range(100): # Create a long enough list
-                    f.write(f"file '{random.choice(v_shuffled).absolute()}'\n")
+            v_lines = [f"file '{os.path.join(cwd, p)}'\n" for p in v]
+            with open(video_list_path, "w", buffering=1 << 20) as f:
+                f.writelines(shuffled(v_lines))
         
         if a:
-            with open(audio_list_path, "w") as f:
-                a_shuffled = list(a)
-                random.shuffle(a_shuffled)
-                for _ in range(100):
-                    f.write(f"file '{random.choice(a_shuffled).absolute()}'\n")
+            a_lines = [f"file '{os.path.join(cwd, p)}'\n" for p in a]
+            with open(audio_list_path, "w", buffering=1 << 20) as f:
+                f.writelines(shuffled(a_lines))
 
-    update_lists()
+    update_lists(vids, auds)
+    has_audio = bool(auds)
 
     cmd = [
         "ffmpeg", "-re",
-        "-f", "concat", "-safe", "0", "-i", str(video_list_path),
+        "-fflags", "nobuffer", "-flags", "low_delay",
+        "-stream_loop", "-1", "-f", "concat", "-safe", "0", "-i", str(video_list_path),
     ]
     
-    if AUDIO_DIR.glob("*"):
-        cmd += ["-f", "concat", "-safe", "0", "-i", str(audio_list_path)]
+    if has_audio:
+        cmd += ["-stream_loop", "-1", "-f", "concat", "-safe", "0", "-i", str(audio_list_path)]
         cmd += [
-            "-c:v", "libx264", "-preset", "veryfast", "-b:v", "4500k",
+            "-c:v", "libx264", "-preset", "veryfast", "-tune", "zerolatency",
+            "-x264-params", "nal-hrd=cbr", "-b:v", "4500k",
             "-maxrate", "4500k", "-bufsize", "9000k",
             "-pix_fmt", "yuv420p", "-g", "60",
             "-c:a", "aac", "-b:a", "128k", "-ar", "44100",
@@ -106,7 +242,8 @@ def run_ffmpeg(stream_key, session_id):
     else:
         cmd += [
             "-f", "lavfi", "-i", "anullsrc=channel_layout=stereo:sample_rate=44100",
-            "-c:v", "libx264", "-preset", "veryfast", "-b:v", "4500k",
+            "-c:v", "libx264", "-preset", "veryfast", "-tune", "zerolatency",
+            "-x264-params", "nal-hrd=cbr", "-b:v", "4500k",
             "-maxrate", "4500k", "-bufsize", "9000k",
             "-pix_fmt", "yuv420p", "-g", "60",
             "-c:a", "aac", "-b:a", "128k",
@@ -117,13 +254,40 @@ def run_ffmpeg(stream_key, session_id):
     
     log_to_database(session_id, "INFO", f"🚀 Starting Seamless Random Stream: {output_url}")
     
+    process = None
     try:
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        st.session_state['ffmpeg_process'] = process
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if slot["starting"]:
+            slot["starting"] = False
+        else:
+            # Stop was pressed before FFmpeg started
+            stop_ffmpeg(psutil.Process(process.pid))
         
-        for line in process.stdout:
-            if "Error" in line or "bitrate" in line:
-                log_to_database(session_id, "FFMPEG", line.strip())
+        # Filter on raw bytes so only the lines we keep get decoded
+        def handle_line(raw):
+            if FFMPEG_LOG_PATTERN.search(raw):
+                log_to_database(session_id, "FFMPEG", raw.decode("utf-8", "replace").strip())
+
+        # Read whatever is available instead of blocking on a full line,
+        # so progress reaches the log writer as soon as FFmpeg emits it
+        fd = process.stdout.fileno()
+        os.set_blocking(fd, False)
+        pending = b""
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            while True:
+                sel.select()
+                try:
+                    chunk = os.read(fd, 1024 * 64)
+                except BlockingIOError:
+                    continue
+                if not chunk:
+                    break
+                *lines, pending = FFMPEG_LINE_SPLIT.split(pending + chunk)
+                for raw in lines:
+                    handle_line(raw)
+        if pending:
+            handle_line(pending)
         
         process.wait()
     except Exception as e:
@@ -132,19 +296,72 @@ def run_ffmpeg(stream_key, session_id):
         if video_list_path.exists(): video_list_path.unlink()
         if audio_list_path.exists(): audio_list_path.unlink()
         log_to_database(session_id, "INFO", "⏹️ Streaming session ended")
-        st.session_state['streaming'] = False
+        if process is None:
+            slot["starting"] = False
+
+def stop_ffmpeg(process):
+    # Only touch our own FFmpeg and its children, never other processes on the host
+    try:
+        children = process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+    try:
+        process.terminate()
+        process.wait(timeout=3)
+    except psutil.TimeoutExpired:
+        process.kill()
+    except psutil.NoSuchProcess:
+        pass
+    for child in children:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+def stop_all_ffmpeg():
+    for process in find_ffmpeg_processes():
+        stop_ffmpeg(process)
+
+# --- UPLOADS ---
+UPLOAD_WORKERS = 4
+
+def save_uploads(uploaded_files, target_dir):
+    def _persist(u):
+        u.seek(0)
+        with open(target_dir / u.name, "wb") as f:
+            shutil.copyfileobj(u, f, length=1024 * 1024)
+
+    # File writes release the GIL, so threads overlap the disk I/O
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as ex:
+        list(ex.map(_persist, uploaded_files))
 
 # --- UI ---
+@st.fragment(run_every=2)
+def live_logs():
+    # Only this panel refreshes every 2 seconds; the full page reruns once the stream ends
+    if not is_streaming():
+        st.rerun()
+    session_id = get_stream_slot()["session_id"] or st.session_state['session_id']
+    with st.expander("📝 Live Logs", expanded=True):
+        conn, lock = get_db()
+        with lock:
+            cursor = conn.execute("SELECT timestamp, message FROM streaming_logs WHERE session_id = ? ORDER BY timestamp DESC LIMIT 50", (session_id,))
+            logs = cursor.fetchall()
+        if logs:
+            for ts, msg in logs:
+                st.text(f"[{ts}] {msg}")
+
 def main():
     st.title("📺 YouTube Live Multi-Media Streamer")
     st.info("ℹ️ Info: Sistem akan memutar Video & Audio secara acak (random) dari folder media.")
     
     init_database()
+    get_log_queue()
     
     if 'session_id' not in st.session_state:
-        st.session_state['session_id'] = f"session_{int(time.time())}"
-    if 'streaming' not in st.session_state:
-        st.session_state['streaming'] = False
+        st.session_state['session_id'] = int(time.time())
+    # App-wide, so any session can see and stop a stream started elsewhere
+    st.session_state['streaming'] = is_streaming()
 
     # 1. Manage Media
     st.header("1. Media Management")
@@ -165,9 +382,7 @@ def main():
         st.subheader("Videos")
         uploaded_videos = st.file_uploader("Upload Videos", type=['mp4', 'mkv', 'mov'], accept_multiple_files=True, help="Max 200MB per file")
         if uploaded_videos:
-            for v in uploaded_videos:
-                with open(VIDEO_DIR / v.name, "wb") as f:
-                    f.write(v.getbuffer())
+            save_uploads(uploaded_videos, VIDEO_DIR)
             st.success(f"Uploaded {len(uploaded_videos)} videos")
         
         v_files = list(VIDEO_DIR.glob("*"))
@@ -185,9 +400,7 @@ def main():
         st.subheader("Audios")
         uploaded_audios = st.file_uploader("Upload Audios", type=['mp3', 'wav', 'm4a'], accept_multiple_files=True, help="Max 200MB per file")
         if uploaded_audios:
-            for a in uploaded_audios:
-                with open(AUDIO_DIR / a.name, "wb") as f:
-                    f.write(a.getbuffer())
+            save_uploads(uploaded_audios, AUDIO_DIR)
             st.success(f"Uploaded {len(uploaded_audios)} audios")
             
         a_files = list(AUDIO_DIR.glob("*"))
@@ -212,11 +425,16 @@ def main():
     
     with col_start:
         if st.button("▶️ Start Streaming", type="primary", use_container_width=True, disabled=st.session_state['streaming']):
-            if not list(VIDEO_DIR.glob("*")) or not stream_key:
+            if is_streaming():
+                st.error("⚠️ A stream is already running!")
+            elif not list(VIDEO_DIR.glob("*")) or not stream_key:
                 st.error("⚠️ Please upload at least one video and provide Stream Key!")
             else:
                 st.session_state['streaming'] = True
                 st.session_state['stream_key'] = stream_key
+                slot = get_stream_slot()
+                slot["starting"] = True
+                slot["session_id"] = st.session_state['session_id']
                 
                 thread = threading.Thread(
                     target=run_ffmpeg, 
@@ -229,9 +447,8 @@ def main():
                 
     with col_stop:
         if st.button("⏹️ Stop Streaming", type="secondary", use_container_width=True, disabled=not st.session_state['streaming']):
-            if 'ffmpeg_process' in st.session_state:
-                st.session_state['ffmpeg_process'].terminate()
-                os.system("pkill ffmpeg")
+            get_stream_slot()["starting"] = False
+            stop_all_ffmpeg()
             
             st.session_state['streaming'] = False
             st.warning("Streaming stopped.")
@@ -240,18 +457,7 @@ def main():
     # Status & Logs
     if st.session_state['streaming']:
         st.error("🔴 STATUS: LIVE (Seamless Random Mode)")
-        with st.expander("📝 Live Logs", expanded=True):
-            conn = sqlite3.connect("streaming_logs.db")
-            cursor = conn.cursor()
-            cursor.execute("SELECT timestamp, message FROM streaming_logs WHERE session_id = ? ORDER BY timestamp DESC LIMIT 50", (st.session_state['session_id'],))
-            logs = cursor.fetchall()
-            conn.close()
-            if logs:
-                for ts, msg in logs:
-                    st.text(f"[{ts}] {msg}")
-        
-        time.sleep(2)
-        st.rerun()
+        live_logs()
 
 if __name__ == "__main__":
     main()